@@ -9,27 +9,66 @@ user_queue_map = json.load(open(os.path.join(os.path.dirname(__file__), 'usermap
 checked_queues = set(['default', 'admin'])
 
 
+def HasConsumers(queue):
+    """Check whether the given Celery queue has (or at least, had!) any consumers."""
+    if queue not in checked_queues:
+        from .tasks import app
+        active_queues = app.control.inspect().active_queues() or {}  # None if no worker replied
+        if queue not in [q['name']
+                         for l in active_queues.values()
+                         for q in l]:
+            return False
+        checked_queues.add(queue)
+    return True
+
+
 def GetQueue(user, isAdmin):
     """Determine which Celery queue to use for a task, based on the user submitting it."""
     if isAdmin:
         queue = 'admin'
     else:
         queue = user_queue_map.get(user, 'default')
-        # Check that the queue has (or at least, had!) consumers and fall back to default if not
-        if queue not in checked_queues:
-            from .tasks import app
-            if queue not in [q['name']
-                             for l in app.control.inspect().active_queues().values()
-                             for q in l]:
-                queue = 'default'
-            else:
-                checked_queues.add(queue)
+        # Check that the queue has consumers and fall back to default if not
+        if not HasConsumers(queue):
+            queue = 'default'
     return queue
 
 
+def GetRunQueue(queue):
+    """Determine which Celery queue to run an experiment on, once checked on the given queue.
+
+    Experiments can take many hours, so ideally run on a separate queue from the short checking
+    tasks, consumed by workers dedicated to them. Unless such queues are configured, the experiment
+    runs as part of the checking task instead, and we return None.
+    """
+    from .celeryconfig import weblab_run_queue_suffix
+    if weblab_run_queue_suffix:
+        return queue + weblab_run_queue_suffix
+    return None
+
+
+def GetRunTaskId(checkTaskId):
+    """Get the id of the task running an experiment on a separate queue, given its checking task."""
+    return checkTaskId + '-run'
+
+
+def GetNotifyQueue():
+    """Determine which Celery queue to use for delayed error notifications.
+
+    These are scheduled with a countdown, and workers reserve such tasks regardless of their
+    prefetch limit, so they should go to a dedicated lightweight worker rather than tie up a
+    slot on one running experiments. Unless such a queue is configured, we use the admin queue.
+    """
+    from .celeryconfig import weblab_notify_queue
+    return weblab_notify_queue or GetQueue('', True)
+
+
 def ScheduleExperiment(
         callbackUrl, signature, modelUrl, protoUrl, user='', isAdmin=False, **kwargs):
-    """Schedule a new experiment for execution."""
+    """Schedule a new experiment for execution.
+
+    Returns the response line telling the web interface which task is running the experiment.
+    """
     from .tasks import CheckExperiment
     # Submit the job
     args = (
@@ -38,16 +77,22 @@ def ScheduleExperiment(
         modelUrl,
         protoUrl,
     )
-    result = CheckExperiment.apply_async(args, kwargs, queue=GetQueue(user, isAdmin))
+    queue = GetQueue(user, isAdmin)
+    run_queue = GetRunQueue(queue)
+    if run_queue:
+        # Only pass this when needed, so workers that predate it can still take the task
+        kwargs['runQueue'] = run_queue
+    result = CheckExperiment.apply_async(args, kwargs, queue=queue)
     # Tell web interface that the call was successful
-    print(signature, "succ", result.task_id)
+    return "%s succ %s" % (signature, result.task_id)
 
 
 def CancelExperiment(taskId):
     """Revoke or terminate an already submitted experiment."""
     import signal
     from .tasks import app
-    app.control.revoke(taskId, terminate=True, signal=signal.SIGUSR1)
+    # The experiment may have been handed on to a separate task to run, so revoke that too
+    app.control.revoke([taskId, GetRunTaskId(taskId)], terminate=True, signal=signal.SIGUSR1)
 
 
 def GetProtocolInterface(callbackUrl, signature, protoUrl):
@@ -12,12 +12,18 @@ broker_url = 'amqp://guest@localhost'
 # Default queue name to use
 task_default_queue = "default"
 
+# Wait for the broker to confirm it has received each task we send
+broker_transport_options = {'confirm_publish': True}
+
 # We expect to have few tasks, but long running, so don't reserve more than you're working on
 # (this works well combined with the -Ofair option to the workers)
 worker_prefetch_multiplier = 1
 task_acks_late = True
-# Since tasks are long-running, we want to know if they are actually running
+task_acks_on_failure_or_timeout = True
+# Since tasks are long-running, we want to know if they are actually running.
+# With no result backend, monitoring tools see this via task events.
 task_track_started = True
+worker_send_task_events = True
 
 # Just in case, restart workers once they've run this many jobs
 worker_max_tasks_per_child = 50
@@ -27,9 +33,9 @@ task_soft_time_limit = 60 * 60 * 15  # 15 hours
 # can set with decorator: @app.task(soft_time_limit=) or config task_soft_time_limit or as soft_time_limit option to apply_async.
 # Also need to look into creating per-user queues dynamically - tricky bit is getting a worker to consume them!
 
-# We need a result backend to track task status.
-# However we don't need to store results, since the tasks will callback to the front-end.
-result_backend = 'rpc'
+# We don't need a result backend, since the tasks will callback to the front-end
+# with their status and results.
+result_backend = None
 task_ignore_result = True
 
 # We don't make use of rate limiting, so turn it off for a performance boost
@@ -41,3 +47,18 @@ weblab_max_callback_attempts = 3
 
 # How long in seconds to wait for the front-end to respond
 weblab_timeout = 60 * 2
+
+# How often in seconds to log that an experiment is still running
+weblab_progress_interval = 60 * 10
+
+# If set (e.g. to '_run'), experiments checked on queue X are run on queue X + this suffix.
+# This keeps long-running experiments from holding up the short checking tasks, but only set it
+# if workers consume these queues, and share the temporary folder with those consuming X.
+# If None, experiments run within the checking task.
+weblab_run_queue_suffix = None
+
+# Queue for delayed error notifications after callbacks fail.
+# Workers reserve tasks with a countdown even when at their prefetch limit, so ideally this queue
+# is consumed by a dedicated small worker rather than those running experiments.
+# Set this (e.g. to 'notify') only if such a worker exists; if None, the admin queue is used.
+weblab_notify_queue = None
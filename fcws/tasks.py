@@ -1,16 +1,18 @@
 # Task queue for Functional Curation web service
 
-import glob
 import os
 import logging
+import select
 import shutil
 import subprocess
 import tempfile
 import time
 import traceback
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 
 import celery
+from celery.signals import task_revoked, worker_process_init
 from celery.exceptions import SoftTimeLimitExceeded
 import requests
 
@@ -22,11 +24,27 @@ from fc.parsing.rdf import get_used_annotations
 from . import config
 from . import celeryconfig
 from . import utils
-from . import GetQueue
+from . import GetNotifyQueue, GetRunTaskId
 
 app = celery.Celery('fcws.tasks')
 app.config_from_object(celeryconfig)
 
+# Settings used by every task; the configuration doesn't change while a worker is running
+_ENVIRON = config['environment']
+_EXE = config['exe_path']
+_FIT = config['fitting_path']
+_VENV = config['fitting_virtualenv']
+_TEMP = config['temp_dir']
+
+# Whether the environment for running experiments has been set up in this process
+_env_applied = False
+
+
+@worker_process_init.connect
+def ResetSession(**kwargs):
+    """Ensure each worker child process opens its own HTTP connections."""
+    utils.ResetSession()
+
 
 def Callback(callbackUrl, signature, data, json=False, isRetriedError=False, **kwargs):
     """Make a callback to the front-end server.
@@ -37,7 +55,7 @@ def Callback(callbackUrl, signature, data, json=False, isRetriedError=False, **k
     @param json: whether to send data as JSON
     @param isRetriedError: whether this callback is simply to report
         that a previous callback timed out
-    @param kwargs: extra parameters for requests.post
+    @param kwargs: extra parameters for requests.Session.post
     """
     data['signature'] = signature
     if json:
@@ -47,15 +65,21 @@ def Callback(callbackUrl, signature, data, json=False, isRetriedError=False, **k
     r = requests.Response()  # In case we never get through
     r.status_code = 500
     for attempt in range(celeryconfig.weblab_max_callback_attempts):
-        r = requests.post(callbackUrl, verify=False, timeout=celeryconfig.weblab_timeout, **kwargs)
-        if 400 <= r.status_code < 600:
-            print("Error attempting callback at attempt %d: %s" % (attempt + 1, str(e)))
-            time.sleep(60 * 2.0**attempt)  # Exponential backoff, in seconds
-            # Rewind any file handles so we read from the beginning again
-            for fp in kwargs.get('files', {}).values():
-                fp.seek(0)
+        try:
+            r = utils.GetSession().post(
+                callbackUrl, verify=False, timeout=celeryconfig.weblab_timeout, **kwargs)
+        except requests.RequestException as e:
+            error = str(e)  # Couldn't connect, or no response in time
         else:
-            break  # Callback successful so don't try again
+            if 400 <= r.status_code < 600:
+                error = "HTTP %d %s" % (r.status_code, r.reason)
+            else:
+                break  # Callback successful so don't try again
+        print("Error attempting callback at attempt %d: %s" % (attempt + 1, error))
+        time.sleep(60 * 2.0**attempt)  # Exponential backoff, in seconds
+        # Rewind any file handles so we read from the beginning again
+        for fp in kwargs.get('files', {}).values():
+            fp.seek(0)
     else:
         print("Giving up on callback after %d attempts." %
               celeryconfig.weblab_max_callback_attempts)
@@ -63,7 +87,7 @@ def Callback(callbackUrl, signature, data, json=False, isRetriedError=False, **k
             # This is the first time we're giving up, so define an error message for later delivery
             data = {'returntype': 'failed', 'returnmsg': 'No response received from server'}
             NotifyOfError.apply_async(
-                (callbackUrl, signature, data), queue=GetQueue('', True), countdown=60 * 5)
+                (callbackUrl, signature, data), queue=GetNotifyQueue(), countdown=60 * 5)
     return r
 
 
@@ -81,10 +105,78 @@ def ReportError(callbackUrl, signature, prefix="failed due to unexpected error:
 def MakeTempDir():
     """Make a temporary folder within the configured location."""
     try:
-        os.makedirs(config['temp_dir'], 0o775)
+        os.makedirs(_TEMP, 0o775)
     except os.error:
         pass
-    return tempfile.mkdtemp(dir=config['temp_dir'])
+    return tempfile.mkdtemp(dir=_TEMP)
+
+
+def ApplyEnvironment():
+    """Set the environment variables used when running experiments, if not already done."""
+    global _env_applied
+    if not _env_applied:
+        log = logging.getLogger(__name__)
+        for key, value in _ENVIRON.items():
+            log.info('Setting environment variable ' + key + ': ' + value)
+            os.environ[key] = value
+        _env_applied = True
+
+
+def ScanOutputs(folder, depth=3):
+    """Find the output files exactly ``depth`` levels below the given folder.
+
+    This is equivalent to globbing ``folder/*/*/*`` for files, but yields os.DirEntry objects
+    so file types come from the directory listing rather than a stat call per path.
+    """
+    try:
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if entry.name.startswith('.'):
+                    continue  # Hidden files wouldn't match a glob
+                if depth > 1:
+                    if entry.is_dir():
+                        yield from ScanOutputs(entry.path, depth - 1)
+                elif entry.is_file():
+                    yield entry
+    except (FileNotFoundError, NotADirectoryError):
+        pass  # No outputs created
+
+
+def WaitForChild(child, signature):
+    """Wait for an experiment process to finish, periodically logging that it is still running.
+
+    Where possible we wait on a pidfd, so we wake as soon as the child exits without sleep-polling.
+    Otherwise we just block until it exits.
+
+    @param child: the subprocess.Popen running the experiment
+    @param signature: unique identifier for this experiment run
+    @return: the child's exit code
+    """
+    log = logging.getLogger(__name__)
+    try:
+        pidfd = os.pidfd_open(child.pid)
+    except (AttributeError, OSError):
+        pidfd = None  # Not supported on this platform
+    if pidfd is not None:
+        try:
+            # Use poll rather than select, which can't handle fds beyond FD_SETSIZE
+            poller = select.poll()
+            poller.register(pidfd, select.POLLIN)
+            while not poller.poll(celeryconfig.weblab_progress_interval * 1000):
+                log.info('Experiment %s still running (pid %d)' % (signature, child.pid))
+        finally:
+            os.close(pidfd)
+    return child.wait()
+
+
+def KillChild(child):
+    """Ask an experiment process to stop, forcibly killing it if it hasn't within 5 seconds."""
+    child.terminate()
+    try:
+        child.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        child.kill()
+        child.wait()
 
 
 @app.task(name="fcws.tasks.GetModelInterface")
@@ -98,11 +190,11 @@ def GetModelInterface(callbackUrl, signature, modelUrl):
     temp_dir = None
     error_prefix = "Unable to determine interface for model due to errors parsing file:\n"
     try:
-        # Download the model archive to a temporary folder & unpack
+        # Download the model archive & unpack to a temporary folder.
+        # We only parse the model itself, so don't need any other files.
         temp_dir = MakeTempDir()
-        model_path = os.path.join(temp_dir, 'model.zip')
-        utils.Wget(modelUrl, model_path, signature)
-        main_model_path = utils.UnpackArchive(model_path, temp_dir, 'model')
+        main_model_path = utils.DownloadAndUnpack(
+            modelUrl, temp_dir, 'model', signature, primaryOnly=True)
         # Parse the model and find annotations
         model = load_model(main_model_path)
         model_terms = get_used_annotations(model)
@@ -133,11 +225,9 @@ def GetProtocolInterface(callbackUrl, signature, protocolUrl):
     temp_dir = None
     error_prefix = "Unable to determine interface for protocol due to errors parsing file:\n"
     try:
-        # Download the protocol archive to a temporary folder & unpack
+        # Download the protocol archive & unpack to a temporary folder
         temp_dir = MakeTempDir()
-        proto_path = os.path.join(temp_dir, 'protocol.zip')
-        utils.Wget(protocolUrl, proto_path, signature)
-        main_proto_path = utils.UnpackArchive(proto_path, temp_dir, 'proto')
+        main_proto_path = utils.DownloadAndUnpack(protocolUrl, temp_dir, 'proto', signature)
         # Check a full parse of the protocol succeeds; only continue if it does
         try:
             proto = Protocol(main_proto_path)
@@ -165,7 +255,8 @@ def GetProtocolInterface(callbackUrl, signature, protocolUrl):
 
 
 @app.task(name="fcws.tasks.CheckExperiment")
-def CheckExperiment(callbackUrl, signature, modelUrl, protocolUrl, datasetUrl=None, fittingSpecUrl=None):
+def CheckExperiment(callbackUrl, signature, modelUrl, protocolUrl, datasetUrl=None, fittingSpecUrl=None,
+                    runQueue=None):
     """Check a model/protocol combination for compatibility.
 
     If the interfaces match up, then the experiment can be run.
@@ -179,41 +270,55 @@ def CheckExperiment(callbackUrl, signature, modelUrl, protocolUrl, datasetUrl=No
     @param protocolUrl: where to download the protocol archive from
     @param datasetUrl: if doing a fit, where to download the reference dataset from
     @param fittingSpecUrl: if doing a fit, the fitting specification
+    @param runQueue: if given, the queue on which to run the experiment itself;
+        otherwise it runs within this task
     """
     log = logging.getLogger(__name__)
 
     try:
-        # Download the submitted COMBINE archives to disk in temporary folder
+        # Download the submitted COMBINE archives & unpack in temporary folder.
+        # Each archive unpacks into its own subfolder, so we can fetch them all concurrently,
+        # splitting the in-memory allowance between them to bound this worker's memory use.
         temp_dir = MakeTempDir()
-        model_path = os.path.join(temp_dir, 'model.zip')
-        proto_path = os.path.join(temp_dir, 'protocol.zip')
-        utils.Wget(modelUrl, model_path, signature)
-        utils.Wget(protocolUrl, proto_path, signature)
-
-        # Unpack the model & protocol
-        main_model_path = utils.UnpackArchive(model_path, temp_dir, 'model')
-        main_proto_path = utils.UnpackArchive(proto_path, temp_dir, 'proto')
-
-        if datasetUrl and fittingSpecUrl:
+        is_fit = datasetUrl and fittingSpecUrl
+        downloads = {
+            'model': (modelUrl, False),
+            'proto': (protocolUrl, False),
+        }
+        if is_fit:
+            downloads['dataset'] = (datasetUrl, True)
+            if fittingSpecUrl != protocolUrl:
+                downloads['fittingSpec'] = (fittingSpecUrl, False)
+        with ThreadPoolExecutor(max_workers=len(downloads)) as executor:
+            futures = {
+                content_type: executor.submit(
+                    utils.DownloadAndUnpack, url, temp_dir, content_type, signature,
+                    ignoreManifest=ignore_manifest,
+                    maxMemory=utils.ARCHIVE_SPOOL_SIZE // len(downloads))
+                for content_type, (url, ignore_manifest) in downloads.items()
+            }
+        main_paths = {content_type: future.result() for content_type, future in futures.items()}
+        main_model_path = main_paths['model']
+        main_proto_path = main_paths['proto']
+
+        if is_fit:
             # We're doing a fit
-            dataset_zip = os.path.join(temp_dir, 'dataset.zip')
-            utils.Wget(datasetUrl, dataset_zip, signature)
-            fitting_data_path = utils.UnpackArchive(dataset_zip, temp_dir, 'dataset', ignoreManifest=True)
+            fitting_data_path = main_paths['dataset']
             if fittingSpecUrl == protocolUrl:
                 # Temporary hack: fitting spec is part of the protocol archive
                 proto_dir, proto_name = os.path.split(main_proto_path)
-                for filename in os.listdir(proto_dir):
-                    if (filename != proto_name and
-                            os.path.splitext(filename)[1] in utils.EXPECTED_EXTENSIONS['fittingSpec']):
-                        fitting_spec_path = os.path.join(proto_dir, filename)
-                        break
-                else:
-                    raise ValueError("Failed to find fitting specification within protocol")
+                with os.scandir(proto_dir) as entries:
+                    for entry in entries:
+                        if (entry.name != proto_name and
+                                os.path.splitext(entry.name)[1] in utils.EXPECTED_EXTENSIONS['fittingSpec'] and
+                                entry.is_file()):
+                            fitting_spec_path = entry.path
+                            break
+                    else:
+                        raise ValueError("Failed to find fitting specification within protocol")
             else:
                 # This is what we're moving towards
-                fitting_spec_zip = os.path.join(temp_dir, 'fittingSpec.zip')
-                utils.Wget(fittingSpecUrl, fitting_spec_zip, signature)
-                fitting_spec_path = utils.UnpackArchive(fitting_spec_zip, temp_dir, 'fittingSpec')
+                fitting_spec_path = main_paths['fittingSpec']
         else:
             # Not a fitting experiment
             fitting_spec_path = fitting_data_path = None
@@ -235,9 +340,7 @@ def CheckExperiment(callbackUrl, signature, modelUrl, protocolUrl, datasetUrl=No
             Callback(callbackUrl, signature, {'returntype': 'inapplicable', 'returnmsg': message})
             shutil.rmtree(temp_dir)
         else:
-            # Run the experiment directly in this task,
-            # to ensure it has access to the unpacked model & protocol
-            RunExperiment(
+            args = (
                 callbackUrl,
                 signature,
                 main_model_path,
@@ -246,11 +349,21 @@ def CheckExperiment(callbackUrl, signature, modelUrl, protocolUrl, datasetUrl=No
                 fitting_data_path,
                 temp_dir,
             )
+            if runQueue:
+                # Hand over to a worker dedicated to long-running experiments.
+                # It needs access to our temporary folder, so must share our filesystem.
+                # Its task id is derived from ours, so that cancelling the experiment still works.
+                RunExperiment.apply_async(
+                    args, queue=runQueue, task_id=GetRunTaskId(CheckExperiment.request.id))
+            else:
+                # Run the experiment directly in this task,
+                # to ensure it has access to the unpacked model & protocol
+                RunExperiment(*args)
     except:
         ReportError(callbackUrl, signature)
 
 
-# @app.task(name="fcws.tasks.RunExperiment")
+@app.task(name="fcws.tasks.RunExperiment")
 def RunExperiment(
         callbackUrl, signature, modelPath, protoPath, fspecPath, fdataPath,
         tempDir):
@@ -274,21 +387,15 @@ def RunExperiment(
         # Call FunctionalCuration exe, writing output to the temporary folder containing inputs
         # (or rather, a subfolder thereof).
         # Also redirect stdout and stderr so we can debug any issues.
-        for key, value in config['environment'].items():
-            os.environ[key] = value
+        ApplyEnvironment()
 
         if fspecPath and fdataPath:
             log.info('Running fitting experiment')
-
-            for key, value in config['environment'].items():
-                log.info('Setting environment variable ' + key + ': ' + value)
-                os.environ[key] = value
-
-            log.info('Using virtual environment ' + config['fitting_virtualenv'])
+            log.info('Using virtual environment ' + _VENV)
 
             args = [
-                config['fitting_path'],
-                config['fitting_virtualenv'],
+                _FIT,
+                _VENV,
                 modelPath,
                 protoPath,
                 fspecPath,
@@ -300,7 +407,7 @@ def RunExperiment(
             log.info('Running functional curation experiment')
 
             args = [
-                config['exe_path'],
+                _EXE,
                 modelPath,
                 protoPath,
                 os.path.join(tempDir, 'output'),
@@ -316,22 +423,17 @@ def RunExperiment(
                 args,
                 stdout=output_file,
                 stderr=subprocess.STDOUT,
-                bufsize=1,
             )
-            retcode = child.wait()
+            retcode = WaitForChild(child, signature)
         except SoftTimeLimitExceeded:
             # If we're timed out, kill off the child process, but send back any partial output
             # - don't re-raise
-            child.terminate()
-            time.sleep(5)
-            child.kill()
+            KillChild(child)
             timeout = True
         except:
             # If any other error happens, just make sure the child is dead then report it
             if child is not None:
-                child.terminate()
-                time.sleep(5)
-                child.kill()
+                KillChild(child)
             raise
         output_file.close()
 
@@ -344,41 +446,38 @@ def RunExperiment(
 
         # Zip up the outputs and post them to the callback
         output_path = os.path.join(tempDir, 'output.zip')
-        output_files = glob.glob(os.path.join(tempDir, 'output', '*', '*', '*'))  # Yuck!
-        output_zip = zipfile.ZipFile(output_path, 'w', zipfile.ZIP_DEFLATED)
+        # Fast compression is plenty here: the archive only travels back to the front-end
+        output_zip = zipfile.ZipFile(output_path, 'w', zipfile.ZIP_DEFLATED, compresslevel=1)
         output_zip.write(child_stdout_name, 'stdout.txt')
-        # Remove any manifest file since we'll need to create a new one with stdout.txt in (and possibly errors.txt)
-        for ofile in output_files:
-            if os.path.basename(ofile) == 'manifest.xml':
-                output_files.remove(ofile)
-                break
+        output_files = {}  # Maps name within the archive to path on disk
+        for entry in ScanOutputs(os.path.join(tempDir, 'output')):
+            # Skip any manifest file since we'll need to create a new one with stdout.txt in
+            # (and possibly errors.txt)
+            if entry.name != 'manifest.xml':
+                output_files.setdefault(entry.name, entry.path)
         if timeout:
             # Add a message about the timeout to the errors.txt file
             # (which is created if not present)
-            for ofile in output_files:
-                if os.path.isfile(ofile) and os.path.basename(ofile) == "errors.txt":
-                    error_file_path = ofile
-                    break
-            else:
-                error_file_path = os.path.join(tempDir, 'errors.txt')
-                output_files.append(error_file_path)
+            error_file_path = output_files.setdefault(
+                'errors.txt', os.path.join(tempDir, 'errors.txt'))
             error_file = open(error_file_path, 'a+')
             error_file.write("\nExperiment terminated due to exceeding time limit\n")
             error_file.close()
-        for ofile in output_files:
-            if os.path.isfile(ofile):
-                output_zip.write(ofile, os.path.basename(ofile))
-        if 'success' in output_zip.namelist():
+        for name, ofile in output_files.items():
+            # Don't spend time trying to compress files that are already compressed
+            if os.path.splitext(name)[1].lower() in utils.COMPRESSED_EXTENSIONS:
+                output_zip.write(ofile, name, zipfile.ZIP_STORED)
+            else:
+                output_zip.write(ofile, name)
+        # Determine the outcome from what we've collected, rather than re-reading the archive
+        if 'success' in output_files:
             outcome = 'success'
+        elif any(name.endswith('plot_data.csv') for name in output_files):
+            outcome = 'partial'  # Some output plots created => might be useful
         else:
-            for filename in output_zip.namelist():
-                if filename.endswith('plot_data.csv'):
-                    outcome = 'partial'  # Some output plots created => might be useful
-                    break
-            else:
-                outcome = 'failed'  # No outputs created => total failure
+            outcome = 'failed'  # No outputs created => total failure
         # Add a manifest with the final contents list
-        manifest = combine_manifest(output_zip.namelist())
+        manifest = combine_manifest(['stdout.txt'] + list(output_files))
         output_zip.writestr('manifest.xml', manifest)
         output_zip.close()
 
@@ -393,6 +492,20 @@ def RunExperiment(
         shutil.rmtree(tempDir)
 
 
+@task_revoked.connect(sender=RunExperiment)
+def CleanUpRevokedExperiment(request=None, terminated=False, **kwargs):
+    """Remove the temporary folder of an experiment cancelled before it started running.
+
+    Once running, RunExperiment tidies up after itself, but if revoked beforehand the worker
+    discards the task without calling it.
+    Note that workers only remember revocations while running, unless started with --statedb.
+    """
+    if not terminated and request is not None and request.args:
+        temp_dir = request.args[-1]
+        if temp_dir and os.path.isdir(temp_dir):
+            shutil.rmtree(temp_dir)
+
+
 @app.task(name="fcws.tasks.NotifyOfError")
 def NotifyOfError(callbackUrl, signature, data):
     """Keep trying to contact the front-end with a short error message.
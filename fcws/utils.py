@@ -7,12 +7,19 @@ and determining which file within is the primary model/protocol.
 It also contains a method for determining whether a model and protocol are compatible.
 """
 
+import io
 import os
+import posixpath
 import sys
 import requests
-import xml.etree.ElementTree as ET
+import requests.adapters
+import shutil
+import tempfile
+import threading
 import zipfile
 
+from lxml import etree as ET
+
 from fc import Protocol
 import fc.parsing.CompactSyntaxParser as CSP
 
@@ -24,47 +31,143 @@ EXPECTED_EXTENSIONS = {'model': ['.cellml'],
                        'fittingSpec': ['.txt']}
 
 MANIFEST = 'manifest.xml'
+MANIFEST_CONTENT_TAG = '{http://identifiers.org/combine.specifications/omex-manifest}content'
+
+# Output files in these formats are already compressed, so are stored as-is when zipping results
+COMPRESSED_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.gif', '.gz', '.bz2', '.xz', '.zip', '.omex'}
+
+# Downloaded archives larger than this many bytes are written to disk rather than kept in memory.
+# When several archives are downloaded at once, they share this allowance.
+ARCHIVE_SPOOL_SIZE = 64 * 1024 * 1024
+
+# HTTP session shared by all requests made from this process, and the pid that created it
+_session = None
+_session_pid = None
+# Guards creation of the session, since concurrent downloads may each ask for it
+_session_lock = threading.Lock()
 
 
-def Wget(url, localPath, signature):
-    """Retrieve a binary file from the given URL and save it to disk."""
-    source = requests.get(url, stream=True, verify=False, headers={
+def GetSession():
+    """Get the HTTP session for this process, creating it if needed.
+
+    Reusing a session lets connections to the front-end be kept alive between requests.
+    Pooled connections can't be shared between processes, so a forked child gets a new session.
+    """
+    global _session, _session_pid
+    with _session_lock:
+        if _session is None or _session_pid != os.getpid():
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=8, pool_maxsize=32, max_retries=0)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _session, _session_pid = session, os.getpid()
+        return _session
+
+
+def ResetSession():
+    """Forget any HTTP session inherited from a parent process."""
+    global _session, _session_pid
+    _session = _session_pid = None
+
+
+def OpenUrl(url, signature):
+    """Start retrieving a binary file from the given URL, returning the streamed response.
+
+    Read the file from the response's ``raw`` stream; any gzip or deflate content encoding is
+    decoded as it is read. Use the response as a context manager, so it is always closed and its
+    connection returns to the session's pool for reuse by later downloads and callbacks.
+    """
+    source = GetSession().get(url, stream=True, verify=False, headers={
         'Authorization': 'Token ' + signature
     })
-    source.raise_for_status()
-    with open(localPath, 'wb') as local_file:
-        for chunk in source.iter_content(chunk_size=10240):
-            if chunk:  # filter out keep-alive new chunks
-                local_file.write(chunk)
+    try:
+        source.raise_for_status()
+    except:
+        source.close()
+        raise
+    source.raw.decode_content = True
+    return source
 
 
-def UnpackArchive(archivePath, tempPath, contentType, ignoreManifest=False):
+def Fetch(url, fileObj, signature):
+    """Retrieve a binary file from the given URL and write it to an open file object."""
+    with OpenUrl(url, signature) as source:
+        shutil.copyfileobj(source.raw, fileObj, 1 << 20)
+
+
+def NewArchiveBuffer(contentLength, maxMemory):
+    """Create a file object in which to download an archive.
+
+    :param contentLength:  the archive's size as given by the Content-Length header, if any
+    :param maxMemory:  the largest archive to hold in memory; others go in a temporary file
+
+    Archives of unknown size are always written to disk.
+    """
+    try:
+        size = int(contentLength)
+    except (TypeError, ValueError):
+        size = None
+    if size is not None and 0 <= size <= maxMemory:
+        return io.BytesIO()
+    return tempfile.TemporaryFile(dir=config['temp_dir'])
+
+
+def DownloadAndUnpack(url, tempPath, contentType, signature, ignoreManifest=False,
+                      primaryOnly=False, maxMemory=None):
+    """Download a COMBINE archive and unpack it, returning the path to the primary unpacked file.
+
+    The archive itself is only written to disk if it is larger than maxMemory bytes
+    (by default ARCHIVE_SPOOL_SIZE).
+    See UnpackArchive for the meaning of the remaining parameters.
+    """
+    if maxMemory is None:
+        maxMemory = ARCHIVE_SPOOL_SIZE
+    with OpenUrl(url, signature) as source:
+        archive = NewArchiveBuffer(source.headers.get('Content-Length'), maxMemory)
+        try:
+            shutil.copyfileobj(source.raw, archive, 1 << 20)
+        except:
+            archive.close()
+            raise
+    with archive:
+        archive.seek(0)
+        return UnpackArchive(archive, tempPath, contentType,
+                             ignoreManifest=ignoreManifest, primaryOnly=primaryOnly)
+
+
+def UnpackArchive(archivePath, tempPath, contentType, ignoreManifest=False, primaryOnly=False):
     """Unpack a COMBINE archive, and return the path to the primary unpacked file.
 
-    :param archivePath:  path to the archive
+    :param archivePath:  path to the archive, or a file object containing it
     :param tempPath:  path to a temporary folder under which to unpack
     :param contentType:  whether the archive contains a model ('model') or protocol ('proto')
     :param ignoreManifest:  if set, ignore the master file specified in the manifest
+    :param primaryOnly:  if set, only unpack the primary file, not the rest of the archive
 
     Files will be unpacked into the path tempPath/contentType.
     """
     assert contentType in EXPECTED_EXTENSIONS
     archive = zipfile.ZipFile(archivePath)
     output_path = os.path.join(tempPath, contentType)
-    archive.extractall(output_path)
+    names = set(archive.namelist())
     # Check if the archive manifest specifies the primary file
     primary_file = None
-    manifest_path = os.path.join(output_path, MANIFEST)
-    if not ignoreManifest and os.path.exists(manifest_path):
-        manifest = ET.parse(manifest_path)
-        for item in manifest.iter(
-                '{http://identifiers.org/combine.specifications/omex-manifest}content'):
-            if item.get('master', 'false') == 'true':
-                primary_file = item.get('location')
-                if primary_file[0] == '/':
-                    # There's some debate over the preferred form of location URIs...
-                    primary_file = primary_file[1:]
-                break
+    if not ignoreManifest and MANIFEST in names:
+        # Read it straight from the archive, and stop parsing as soon as we find the master entry
+        with archive.open(MANIFEST) as manifest:
+            # The manifest is user-supplied, so never load external entities or network resources
+            for _, item in ET.iterparse(manifest, tag=MANIFEST_CONTENT_TAG,
+                                        resolve_entities=False, no_network=True):
+                if item.get('master', 'false') == 'true':
+                    primary_file = item.get('location')
+                    if primary_file[0] == '/':
+                        # There's some debate over the preferred form of location URIs...
+                        primary_file = primary_file[1:]
+                    # ...and it may also be given relative to the archive root, e.g. ./model.cellml
+                    primary_file = posixpath.normpath(primary_file)
+                    break
+                item.clear()
     if not primary_file:
         # No manifest or no master listed, so try to figure it out ourselves:
         # find the first item with expected extension
@@ -75,10 +178,13 @@ def UnpackArchive(archivePath, tempPath, contentType, ignoreManifest=False):
                 break
     if not primary_file:
         raise ValueError('No suitable primary file detected in COMBINE archive')
-    primary_path = os.path.join(output_path, primary_file)
-    if not os.path.exists(primary_path):
+    if primary_file not in names:
         raise ValueError('Declared primary file not present in archive')
-    return primary_path
+    if primaryOnly:
+        archive.extract(primary_file, output_path)
+    else:
+        archive.extractall(output_path)
+    return os.path.join(output_path, primary_file)
 
 
 def DetermineCompatibility(protoPath, modelPath):
@@ -0,0 +1,98 @@
+# Request handling for the Functional Curation web service
+
+import logging
+import traceback
+import urllib.parse
+
+from . import (
+    CancelExperiment,
+    GetModelInterface,
+    GetProtocolInterface,
+    ScheduleExperiment,
+    config,
+)
+
+
+def ParseForm(environ):
+    """Parse the sent objects: just a handful of short fields, so read the POST body directly."""
+    try:
+        # A negative length would read until the client closes the connection
+        content_length = max(0, int(environ.get('CONTENT_LENGTH') or 0))
+    except ValueError:
+        content_length = 0
+    body = environ['wsgi.input'].read(content_length).decode('utf-8', 'replace')
+    return dict(urllib.parse.parse_qsl(body, keep_blank_values=True))
+
+
+def ErrorPage(msg):
+    """Build the response reporting an invalid request."""
+    return ('text/html',
+            "<html><head><title>ChastePermissionError</title></head><body>%s</body></html>" % msg)
+
+
+def HandleRequest(form):
+    """Carry out the requested action, returning the content type and body of the response.
+
+    @param form: dictionary of the fields POSTed by the front-end
+    """
+    if 'password' not in form or form['password'] != config['password']:
+        return ErrorPage("Missing or incorrect password supplied.")
+
+    if 'cancelTask' in form:
+        # Special action: cancel or revoke an experiment
+        CancelExperiment(form['cancelTask'])
+        return 'text/plain', ''
+    elif 'getModelInterface' in form:
+        # Special action: get the ontology interface for a model
+        for field in ['callBack', 'signature']:
+            if field not in form:
+                return ErrorPage("Missing required field.")
+        GetModelInterface(form['callBack'], form['signature'], form['getModelInterface'])
+        return 'text/plain', ''
+    elif 'getProtoInterface' in form:
+        # Special action: get the ontology interface for a protocol
+        for field in ['callBack', 'signature']:
+            if field not in form:
+                return ErrorPage("Missing required field.")
+        GetProtocolInterface(form['callBack'], form['signature'], form['getProtoInterface'])
+        return 'text/plain', ''
+    else:
+        # Standard action: schedule experiment
+        for field in ['callBack', 'signature', 'model', 'protocol', 'user', 'isAdmin']:
+            if field not in form:
+                return ErrorPage("Missing required field.")
+
+        signature = form["signature"]
+        # Wrap the rest in a try so we alert the caller properly if an exception occurs
+        try:
+            callBack = form["callBack"]
+            modelUrl = form["model"]
+            protocolUrl = form["protocol"]
+            args = (callBack, signature, modelUrl, protocolUrl)
+            kwargs = {
+                'user': form['user'],
+                'isAdmin': (form['isAdmin'] == 'true'),
+            }
+            # Front-end versions differ in what they call the fitting fields, so accept either
+            dataset = form.get('dataset') or form.get('fittingDataUrl')
+            fitting_spec = form.get('fittingSpec') or form.get('fittingSpecUrl')
+            if dataset and fitting_spec:
+                kwargs['datasetUrl'] = dataset
+                kwargs['fittingSpecUrl'] = fitting_spec
+            return 'text/plain', ScheduleExperiment(*args, **kwargs) + '\n'
+        except Exception as e:
+            logging.getLogger(__name__).exception('Failed to schedule experiment %s' % signature)
+            return 'text/plain', ("%s failed due to unexpected error: %s <br/>\n"
+                                  "Full internal details follow:<br/>\n%s"
+                                  % (signature, e, traceback.format_exc()))
+
+
+def application(environ, start_response):
+    """WSGI entry point."""
+    content_type, body = HandleRequest(ParseForm(environ))
+    body = body.encode('utf-8')
+    start_response('200 OK', [
+        ('Content-Type', content_type),
+        ('Content-Length', str(len(body))),
+    ])
+    return [body]
@@ -0,0 +1,131 @@
+# Tests for fcws.tasks
+
+import io
+
+import pytest
+
+pytest.importorskip('celery')
+pytest.importorskip('cellmlmanip')
+pytest.importorskip('fc')
+requests = pytest.importorskip('requests')
+
+import fcws  # noqa: E402
+from fcws import tasks  # noqa: E402
+
+
+def make_response(status_code, reason):
+    response = requests.Response()
+    response.status_code = status_code
+    response.reason = reason
+    return response
+
+
+class FakeSession:
+    """Replays a sequence of outcomes for callback POSTs, recording each request made."""
+
+    def __init__(self, outcomes):
+        self.outcomes = list(outcomes)
+        self.posts = []
+
+    def post(self, url, **kwargs):
+        # Note where each file was read from, then read it as requests would
+        positions = {name: fp.tell() for name, fp in kwargs.get('files', {}).items()}
+        for fp in kwargs.get('files', {}).values():
+            fp.read()
+        self.posts.append((url, kwargs, positions))
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+
+@pytest.fixture
+def callback_env(monkeypatch):
+    """Patch out the network, sleeping and task scheduling used by Callback."""
+    env = {'sleeps': [], 'notifications': []}
+    monkeypatch.setattr(tasks.time, 'sleep', env['sleeps'].append)
+    monkeypatch.setattr(
+        tasks.NotifyOfError, 'apply_async',
+        lambda *args, **kwargs: env['notifications'].append((args, kwargs)))
+
+    def use_outcomes(*outcomes):
+        env['session'] = FakeSession(outcomes)
+        monkeypatch.setattr(tasks.utils, 'GetSession', lambda: env['session'])
+
+    env['use_outcomes'] = use_outcomes
+    return env
+
+
+def test_callback_gives_up_after_errors(callback_env):
+    callback_env['use_outcomes'](
+        make_response(500, 'Internal Server Error'),
+        requests.ConnectionError('connection refused'),
+        make_response(503, 'Service Unavailable'),
+    )
+    experiment = io.BytesIO(b'zip data')
+
+    r = tasks.Callback('http://example.com/callback', 'sig', {'returntype': 'success'},
+                       files={'experiment': experiment})
+
+    assert r.status_code == 503
+    session = callback_env['session']
+    assert len(session.posts) == tasks.celeryconfig.weblab_max_callback_attempts == 3
+    for url, kwargs, positions in session.posts:
+        assert url == 'http://example.com/callback'
+        assert kwargs['data'] == {'returntype': 'success', 'signature': 'sig'}
+        assert positions == {'experiment': 0}  # File rewound before each attempt
+    assert callback_env['sleeps'] == [60, 120, 240]
+    assert callback_env['notifications'] == [(
+        (('http://example.com/callback', 'sig',
+          {'returntype': 'failed', 'returnmsg': 'No response received from server'}),),
+        {'queue': fcws.GetNotifyQueue(), 'countdown': 300},
+    )]
+
+
+def test_callback_retries_until_success(callback_env):
+    callback_env['use_outcomes'](
+        requests.ConnectionError('connection refused'),
+        make_response(200, 'OK'),
+    )
+
+    r = tasks.Callback('http://example.com/callback', 'sig', {'returntype': 'running'}, json=True)
+
+    assert r.status_code == 200
+    assert len(callback_env['session'].posts) == 2
+    assert callback_env['session'].posts[-1][1]['json'] == {'returntype': 'running', 'signature': 'sig'}
+    assert callback_env['sleeps'] == [60]
+    assert callback_env['notifications'] == []
+
+
+def test_callback_retried_error_not_renotified(callback_env):
+    callback_env['use_outcomes'](*[make_response(500, 'Internal Server Error')] * 3)
+
+    tasks.Callback('http://example.com/callback', 'sig', {'returntype': 'failed'},
+                   isRetriedError=True)
+
+    assert len(callback_env['session'].posts) == 3
+    assert callback_env['notifications'] == []
+
+
+@pytest.mark.parametrize('suffix,run_queue', [(None, None), ('_run', 'admin_run')])
+def test_schedule_experiment_run_queue(monkeypatch, suffix, run_queue):
+    submitted = []
+
+    class FakeResult:
+        task_id = 'task-id'
+
+    def apply_async(args, kwargs, queue):
+        submitted.append((args, kwargs, queue))
+        return FakeResult()
+
+    monkeypatch.setattr(tasks.celeryconfig, 'weblab_run_queue_suffix', suffix)
+    monkeypatch.setattr(tasks.CheckExperiment, 'apply_async', apply_async)
+
+    response = fcws.ScheduleExperiment('http://example.com/callback', 'sig', 'model', 'proto',
+                                       isAdmin=True)
+
+    assert response == 'sig succ task-id'
+    args, kwargs, queue = submitted[0]
+    assert queue == 'admin'
+    # The runQueue argument is only sent when run queues are in use
+    assert kwargs == ({} if run_queue is None else {'runQueue': run_queue})
@@ -0,0 +1,186 @@
+# Tests for fcws.utils
+
+import io
+import os
+import zipfile
+
+import pytest
+
+pytest.importorskip('fc')
+pytest.importorskip('lxml')
+pytest.importorskip('requests')
+
+from fcws import utils  # noqa: E402
+
+
+MANIFEST_XML = b'''<?xml version="1.0" encoding="utf-8"?>
+<omexManifest xmlns="http://identifiers.org/combine.specifications/omex-manifest">
+    <content location="./manifest.xml" format="http://identifiers.org/combine.specifications/omex-manifest"/>
+    <content location="./other.cellml" format="http://identifiers.org/combine.specifications/cellml"/>
+    <content location="./main.cellml" format="http://identifiers.org/combine.specifications/cellml" master="true"/>
+</omexManifest>
+'''
+
+
+def make_archive(padding=0):
+    """Build a small COMBINE archive in memory, optionally padded with an incompressible file."""
+    data = io.BytesIO()
+    with zipfile.ZipFile(data, 'w') as archive:
+        archive.writestr('manifest.xml', MANIFEST_XML)
+        archive.writestr('other.cellml', b'<model name="other"/>')
+        archive.writestr('main.cellml', b'<model name="main"/>')
+        if padding:
+            archive.writestr('padding.bin', os.urandom(padding))
+    return data.getvalue()
+
+
+class FakeResponse:
+    """Stands in for the streamed response returned by utils.OpenUrl."""
+
+    def __init__(self, body, contentLength):
+        self.raw = io.BytesIO(body)
+        self.headers = {} if contentLength is None else {'Content-Length': contentLength}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.raw.close()
+
+
+@pytest.fixture
+def archive_buffers(monkeypatch, tmp_path):
+    """Record the buffers DownloadAndUnpack creates, keeping temporary files under tmp_path."""
+    monkeypatch.setitem(utils.config, 'temp_dir', str(tmp_path))
+    buffers = []
+    new_archive_buffer = utils.NewArchiveBuffer
+
+    def recording_new_archive_buffer(contentLength, maxMemory):
+        buffers.append(new_archive_buffer(contentLength, maxMemory))
+        return buffers[-1]
+
+    monkeypatch.setattr(utils, 'NewArchiveBuffer', recording_new_archive_buffer)
+    return buffers
+
+
+def fake_open_url(monkeypatch, body, contentLength):
+    def open_url(url, signature):
+        assert url == 'http://example.com/model'
+        assert signature == 'sig'
+        return FakeResponse(body, contentLength)
+
+    monkeypatch.setattr(utils, 'OpenUrl', open_url)
+
+
+@pytest.mark.parametrize('padding,known_size,in_memory', [
+    (0, True, True),
+    (4096, True, False),
+    (0, False, False),
+])
+def test_download_and_unpack(monkeypatch, tmp_path, archive_buffers, padding, known_size, in_memory):
+    archive_bytes = make_archive(padding)
+    fake_open_url(monkeypatch, archive_bytes, str(len(archive_bytes)) if known_size else None)
+
+    main_path = utils.DownloadAndUnpack(
+        'http://example.com/model', str(tmp_path), 'model', 'sig', maxMemory=2048)
+
+    assert main_path == os.path.join(str(tmp_path), 'model', 'main.cellml')
+    with open(main_path, 'rb') as main_file:
+        assert main_file.read() == b'<model name="main"/>'
+    assert os.path.exists(os.path.join(str(tmp_path), 'model', 'other.cellml'))
+    # Check the archive was held where we expected, and has been closed
+    assert len(archive_buffers) == 1
+    assert isinstance(archive_buffers[0], io.BytesIO) == in_memory
+    assert archive_buffers[0].closed
+
+
+def test_download_and_unpack_primary_only(monkeypatch, tmp_path, archive_buffers):
+    archive_bytes = make_archive()
+    fake_open_url(monkeypatch, archive_bytes, str(len(archive_bytes)))
+
+    main_path = utils.DownloadAndUnpack(
+        'http://example.com/model', str(tmp_path), 'model', 'sig', primaryOnly=True)
+
+    assert os.path.exists(main_path)
+    assert os.listdir(os.path.join(str(tmp_path), 'model')) == ['main.cellml']
+
+
+@pytest.mark.parametrize('contentLength,in_memory', [
+    ('0', True),
+    ('100', True),
+    ('101', False),
+    ('-1', False),
+    ('junk', False),
+    (None, False),
+])
+def test_new_archive_buffer(monkeypatch, tmp_path, contentLength, in_memory):
+    monkeypatch.setitem(utils.config, 'temp_dir', str(tmp_path))
+    with utils.NewArchiveBuffer(contentLength, 100) as buffer:
+        assert isinstance(buffer, io.BytesIO) == in_memory
+        buffer.write(b'data')
+        buffer.seek(0)
+        assert buffer.read() == b'data'
+
+
+def test_download_and_unpack_default_memory_limit(monkeypatch, tmp_path, archive_buffers):
+    # The default limit is looked up when called, so can be changed after import
+    archive_bytes = make_archive(4096)
+    fake_open_url(monkeypatch, archive_bytes, str(len(archive_bytes)))
+    monkeypatch.setattr(utils, 'ARCHIVE_SPOOL_SIZE', 1024)
+
+    utils.DownloadAndUnpack('http://example.com/model', str(tmp_path), 'model', 'sig')
+
+    assert not isinstance(archive_buffers[0], io.BytesIO)
+
+
+def test_get_session_shared_between_threads(monkeypatch):
+    from concurrent.futures import ThreadPoolExecutor
+    import threading
+    import time
+    import requests
+
+    utils.ResetSession()
+    created = []
+    barrier = threading.Barrier(4)
+
+    class SlowSession(requests.Session):
+        def __init__(self):
+            created.append(self)
+            time.sleep(0.05)  # Give other threads a chance to race us
+            super().__init__()
+
+    def get_session():
+        barrier.wait()  # Make the threads all ask for the session together
+        return utils.GetSession()
+
+    monkeypatch.setattr(utils.requests, 'Session', SlowSession)
+    try:
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            sessions = list(executor.map(lambda _: get_session(), range(4)))
+    finally:
+        utils.ResetSession()
+
+    assert len(created) == 1
+    assert all(session is created[0] for session in sessions)
+
+
+def test_manifest_external_entities_not_loaded(tmp_path):
+    # Manifests come from user-uploaded archives, so mustn't be able to pull in local files
+    secret_path = tmp_path / 'secret.xml'
+    secret_path.write_bytes(b'<not well-formed')
+    manifest = ('''<?xml version="1.0" encoding="utf-8"?>
+<!DOCTYPE omexManifest [<!ENTITY secret SYSTEM "%s">]>
+<omexManifest xmlns="http://identifiers.org/combine.specifications/omex-manifest">
+    <content location="./main.cellml" format="http://identifiers.org/combine.specifications/cellml"
+             master="true">&secret;</content>
+</omexManifest>
+''' % secret_path.as_uri()).encode()
+    data = io.BytesIO()
+    with zipfile.ZipFile(data, 'w') as archive:
+        archive.writestr('manifest.xml', manifest)
+        archive.writestr('main.cellml', b'<model name="main"/>')
+    data.seek(0)
+
+    main_path = utils.UnpackArchive(data, str(tmp_path), 'model')
+
+    assert main_path == os.path.join(str(tmp_path), 'model', 'main.cellml')
@@ -0,0 +1,122 @@
+# Tests for fcws.webservice
+
+import io
+
+import pytest
+
+from fcws import webservice
+
+
+def make_environ(body, contentLength=None):
+    if contentLength is None:
+        contentLength = str(len(body))
+    return {'CONTENT_LENGTH': contentLength, 'wsgi.input': io.BytesIO(body)}
+
+
+@pytest.fixture
+def scheduled(monkeypatch):
+    """Capture experiments scheduled by the web service, rather than submitting them."""
+    monkeypatch.setitem(webservice.config, 'password', 'secret')
+    calls = []
+
+    def schedule(*args, **kwargs):
+        calls.append((args, kwargs))
+        return '%s succ task-id' % args[1]
+
+    monkeypatch.setattr(webservice, 'ScheduleExperiment', schedule)
+    return calls
+
+
+EXPERIMENT_FIELDS = {
+    'password': 'secret',
+    'callBack': 'http://example.com/callback',
+    'signature': 'sig',
+    'model': 'http://example.com/model',
+    'protocol': 'http://example.com/protocol',
+    'user': 'someone',
+    'isAdmin': 'false',
+}
+
+
+def test_parse_form():
+    form = webservice.ParseForm(make_environ(b'password=p%26w&signature=&model=a+b'))
+    assert form == {'password': 'p&w', 'signature': '', 'model': 'a b'}
+
+
+@pytest.mark.parametrize('contentLength', ['', 'junk', '-1', '0'])
+def test_parse_form_bad_length(contentLength):
+    environ = make_environ(b'password=secret', contentLength)
+    assert webservice.ParseForm(environ) == {}
+    assert environ['wsgi.input'].tell() == 0  # Nothing was read
+
+
+def test_parse_form_no_length():
+    assert webservice.ParseForm({'wsgi.input': io.BytesIO(b'password=secret')}) == {}
+
+
+@pytest.mark.parametrize('password', [None, 'wrong'])
+def test_bad_password(scheduled, password):
+    form = dict(EXPERIMENT_FIELDS)
+    if password is None:
+        del form['password']
+    else:
+        form['password'] = password
+    content_type, body = webservice.HandleRequest(form)
+    assert content_type == 'text/html'
+    assert 'incorrect password' in body
+    assert scheduled == []
+
+
+@pytest.mark.parametrize('field', ['callBack', 'signature', 'model', 'protocol', 'user', 'isAdmin'])
+def test_missing_field(scheduled, field):
+    form = dict(EXPERIMENT_FIELDS)
+    del form[field]
+    content_type, body = webservice.HandleRequest(form)
+    assert content_type == 'text/html'
+    assert 'Missing required field' in body
+    assert scheduled == []
+
+
+def test_schedule_experiment(scheduled):
+    content_type, body = webservice.HandleRequest(dict(EXPERIMENT_FIELDS))
+    assert (content_type, body) == ('text/plain', 'sig succ task-id\n')
+    assert scheduled == [(
+        ('http://example.com/callback', 'sig', 'http://example.com/model', 'http://example.com/protocol'),
+        {'user': 'someone', 'isAdmin': False},
+    )]
+
+
+@pytest.mark.parametrize('dataset_field,spec_field', [
+    ('dataset', 'fittingSpec'),
+    ('fittingDataUrl', 'fittingSpecUrl'),
+])
+def test_schedule_fitting_experiment(scheduled, dataset_field, spec_field):
+    form = dict(EXPERIMENT_FIELDS, isAdmin='true')
+    form[dataset_field] = 'http://example.com/data'
+    form[spec_field] = 'http://example.com/spec'
+    webservice.HandleRequest(form)
+    assert scheduled[0][1] == {
+        'user': 'someone',
+        'isAdmin': True,
+        'datasetUrl': 'http://example.com/data',
+        'fittingSpecUrl': 'http://example.com/spec',
+    }
+
+
+def test_schedule_failure(monkeypatch, scheduled):
+    def fail(*args, **kwargs):
+        raise RuntimeError('broker down')
+
+    monkeypatch.setattr(webservice, 'ScheduleExperiment', fail)
+    content_type, body = webservice.HandleRequest(dict(EXPERIMENT_FIELDS))
+    assert content_type == 'text/plain'
+    assert body.startswith('sig failed due to unexpected error: broker down')
+
+
+def test_application(scheduled):
+    body = b'&'.join(('%s=%s' % item).encode() for item in EXPERIMENT_FIELDS.items())
+    responses = []
+    result = webservice.application(
+        make_environ(body), lambda status, headers: responses.append((status, dict(headers))))
+    assert result == [b'sig succ task-id\n']
+    assert responses == [('200 OK', {'Content-Type': 'text/plain', 'Content-Length': '17'})]